@@ -1,113 +1,618 @@
+import copy
+import hashlib
+import math
+import os
+import pickle
+import tomllib
+import warnings
+from collections import OrderedDict
+from enum import IntEnum
+
+import numpy as np
+from scipy.special import entr, logsumexp
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:  # 未安装numba时退化为纯Python实现
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+    prange = range
+
+# 知识库：先验与条件概率表统一由 cpt.toml 提供（加载见 _load_knowledge_base）
+KNOWLEDGE_BASE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'cpt.toml'
+)
+
+# 默认诊断空间Ω
+DIAGNOSIS_SPACE = ['DDLPS', 'RMS', 'UPS', 'LMS', 'WDLPS', 'MPNST', '纤维瘤病', '其他肉瘤']
+
+# 诊断报告缓存容量（病例数），超出时淘汰最久未用的病例
+REPORT_CACHE_SIZE = 1024
+
+
+# 形态学特征编码：特征位置及各特征取值
+class Feat(IntEnum):
+    CELL = 0       # 细胞类型
+    ATYPIA = 1     # 异型性
+    MITOSIS = 2    # 核分裂
+    NECROSIS = 3   # 坏死
+
+
+class Cell(IntEnum):
+    SPINDLE = 1      # 梭形细胞
+    EPITHELIOID = 2  # 上皮样细胞
+    ROUND = 3        # 小圆细胞
+    PLEOMORPHIC = 4  # 多形性细胞
+
+
+class Atypia(IntEnum):
+    LOW = 1
+    HIGH = 2
+
+
+class Mitosis(IntEnum):
+    UNSPECIFIED = 0  # 未描述/无法识别
+    RARE = 1
+    FREQUENT = 2
+
+
+class Necrosis(IntEnum):
+    UNSPECIFIED = 0  # 未描述/无法识别
+    ABSENT = 1
+    PRESENT = 2
+
+
+# 病理描述（中文）→ 枚举编码，extract_* 返回字符串时在边界处解码；
+# 异型性除“高”类描述外一律按低级处理（与原判定逻辑一致），
+# 核分裂/坏死不参与候选诊断选择，无法识别时记为 UNSPECIFIED
+CELL_CODE = {
+    '梭形细胞': Cell.SPINDLE,
+    '上皮样细胞': Cell.EPITHELIOID,
+    '小圆细胞': Cell.ROUND,
+    '多形性细胞': Cell.PLEOMORPHIC
+}
+ATYPIA_CODE = {
+    '低': Atypia.LOW, '轻度': Atypia.LOW, '低异型性': Atypia.LOW,
+    '高': Atypia.HIGH, '显著': Atypia.HIGH, '高异型性': Atypia.HIGH,
+    '显著（大小形态不一）': Atypia.HIGH
+}
+MITOSIS_CODE = {
+    '少见': Mitosis.RARE, '罕见': Mitosis.RARE,
+    '多见': Mitosis.FREQUENT, '易见': Mitosis.FREQUENT,
+    '核分裂多': Mitosis.FREQUENT
+}
+NECROSIS_CODE = {
+    False: Necrosis.ABSENT, '无': Necrosis.ABSENT, '无坏死': Necrosis.ABSENT,
+    True: Necrosis.PRESENT, '有': Necrosis.PRESENT, '可见坏死': Necrosis.PRESENT,
+    '灶性坏死': Necrosis.PRESENT
+}
+
+
+def _decode_feature(value, enum, codes, default=None):
+    """
+    形态学特征取值 → 枚举编码：字符串/布尔值/None 查解码表，整数按枚举取值；
+    无法识别时返回 default，default 为 None 则报错
+    """
+    if isinstance(value, enum):
+        return value
+    if value is None or isinstance(value, (str, bool)):
+        if value in codes:
+            return codes[value]
+    else:
+        try:
+            return enum(value)
+        except ValueError:
+            pass
+    if default is None:
+        raise ValueError('未知的形态学描述: %r' % (value,))
+    return default
+
+
+# 部位分桶：好发部位为1，其余为0
+LOC2IDX = {'大腿深部': 1, '腹膜后': 1}
+NUM_LOCS = 2
+
+# (细胞类型, 异型性) → 形态学候选诊断
+MORPH_CANDIDATES = {
+    (Cell.SPINDLE, Atypia.HIGH): ('DDLPS', 'UPS', 'LMS', 'MPNST'),
+    (Cell.SPINDLE, Atypia.LOW): ('WDLPS', '纤维瘤病')
+}
+
+# 形态学状态打包：每个特征占3位，位置为 Feat × 3
+MORPH_BITS = 3
+
+
+def _pack_morphology(cell, atypia, mitosis, necrosis):
+    """
+    四项形态学特征 → 单个整数状态
+    """
+    return (
+        cell << (MORPH_BITS * Feat.CELL) |
+        atypia << (MORPH_BITS * Feat.ATYPIA) |
+        mitosis << (MORPH_BITS * Feat.MITOSIS) |
+        necrosis << (MORPH_BITS * Feat.NECROSIS)
+    )
+
+
+# 打包状态 → 形态学候选诊断，覆盖全部核分裂/坏死取值（含 UNSPECIFIED）
+MORPH_LOOKUP = {
+    _pack_morphology(cell, atypia, mitosis, necrosis): candidates
+    for (cell, atypia), candidates in MORPH_CANDIDATES.items()
+    for mitosis in Mitosis
+    for necrosis in Necrosis
+}
+
+# 免疫组化标志物位编码：阳性标志物集合打包为一个整数
+M_CK = 1 << 0
+M_EMA = 1 << 1
+M_SMA = 1 << 2
+M_DESMIN = 1 << 3
+M_CALDESMON = 1 << 4
+M_MYOGENIN = 1 << 5
+M_MYOD1 = 1 << 6
+M_S100 = 1 << 7
+M_SOX10 = 1 << 8
+M_CD31 = 1 << 9
+M_ERG = 1 << 10
+M_CD34 = 1 << 11
+M_MDM2 = 1 << 12
+M_CDK4 = 1 << 13
+M_MYOGLOBIN = 1 << 14
+
+MARKER_BIT = {
+    'CK': M_CK, 'EMA': M_EMA, 'SMA': M_SMA, 'Desmin': M_DESMIN,
+    'Caldesmon': M_CALDESMON, 'Myogenin': M_MYOGENIN, 'MyoD1': M_MYOD1,
+    'S100': M_S100, 'SOX10': M_SOX10, 'CD31': M_CD31, 'ERG': M_ERG,
+    'CD34': M_CD34, 'MDM2': M_MDM2, 'CDK4': M_CDK4, 'Myoglobin': M_MYOGLOBIN
+}
+
+# 标志物下标：与位编码一致，MARKER_BIT[m] == 1 << MARKER_IDX[m]
+MARKER_IDX = {m: i for i, m in enumerate(MARKER_BIT)}
+NUM_MARKERS = len(MARKER_IDX)
+MARKER_WEIGHTS = np.left_shift(1, np.arange(NUM_MARKERS, dtype=np.int64))
+
+# 间叶分化谱系掩码
+LINEAGE_MASK = {
+    'smooth_muscle': M_SMA | M_DESMIN | M_CALDESMON,
+    'skeletal_muscle': M_MYOGENIN | M_DESMIN | M_MYOD1,
+    'neural': M_S100 | M_SOX10,
+    'vascular': M_CD31 | M_ERG | M_CD34,
+    'adipocytic': M_MDM2 | M_CDK4
+}
+
+# 冲突规则表：证据位图满足 (全部必需位, 无禁止位) 即触发对应处理动作
+E_MORPH_NON_LPS = 1 << NUM_MARKERS  # 形态学候选不含DDLPS
+A_MOLECULAR_PRIORITY = 0            # MDM2+ but morphology atypical
+A_EXCLUSION_LOGIC = 1               # Myoglobin+ but Myogenin-
+
+CONFLICT_RULES = np.array([
+    (M_MDM2 | E_MORPH_NON_LPS, 0, A_MOLECULAR_PRIORITY),
+    (M_MYOGLOBIN, M_MYOGENIN, A_EXCLUSION_LOGIC)
+], dtype=[('req', 'u8'), ('forbid', 'u8'), ('action', 'i4')])
+
+# 处理动作 → 解决方案
+CONFLICT_RESOLUTIONS = (
+    {   # 分子标志物优先
+        'priority': 'molecular',
+        'action': '保持DDLPS诊断，注释形态学变异',
+        'confidence_penalty': -0.05
+    },
+    {   # 逻辑排除优先
+        'priority': 'exclusion_logic',
+        'interpretation': '异源性分化而非原发RMS',
+        'confidence_boost': +0.10
+    }
+)
+
+def _load_knowledge_base(path=KNOWLEDGE_BASE_PATH):
+    """
+    读取 cpt.toml → 知识库字典（由各引擎实例各自持有）
+    """
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+
+def _pack_ihc(ihc_results):
+    """
+    {标志物: 表达量} → 按 MARKER_IDX 排列的 float32 向量，未检测者为 NaN
+    """
+    vec = np.full(NUM_MARKERS, np.nan, dtype=np.float32)
+    for marker, value in ihc_results.items():
+        i = MARKER_IDX.get(marker)
+        if i is not None:
+            vec[i] = value
+    return vec
+
+
+def _positive_bits(ihc_vec):
+    """
+    标志物向量 → 阳性标志物位图（未检测者 NaN 不计阳性）
+    """
+    return int((ihc_vec > 0) @ MARKER_WEIGHTS)
+
+
+def _build_cpt(lik, diagnoses):
+    """
+    按诊断空间展开IHC条件概率表 P(标志物阳性 | 诊断)
+    lik 为知识库 [lik] 段：{标志物: {诊断: 阳性率, 'background': 背景阳性率}}
+    形状 (标志物数, 诊断数, 2)，末维 0=阴性、1=阳性
+    """
+    cpt = np.empty((len(lik), len(diagnoses), 2))
+    for m, table in enumerate(lik.values()):
+        positive = np.array([table.get(d, table['background']) for d in diagnoses])
+        cpt[m, :, 1] = positive
+        cpt[m, :, 0] = 1 - positive
+    return cpt
+
+
+# Q0.7 定点：概率 p 存为 round(p × 127) 的 int8
+Q7_SCALE = 127
+
+# 定点值 → 对数概率查表；0 按 1e-12 截断（仅知识库中概率恰为0时使用）
+_LOG_Q7 = np.log(np.maximum(np.arange(Q7_SCALE + 1) / Q7_SCALE, 1e-12))
+
+
+class DiagnosisJunctionTree:
+    """
+    诊断网络 Clinical → Dx → {IHC标志物, Morph} 的联结树
+    团 {Clinical, Dx}、{Dx, IHC_m}、{Dx, Morph} 以分隔集 Dx 相连；
+    势函数在构造时以 Q0.7 定点编译一次，查询时只做证据吸收（经查表取对数）
+    与 Dx 团归一化
+    """
+    
+    def __init__(self, markers, cpt):
+        self.markers = list(markers)  # CPT各行对应的标志物
+        self.cpt_rows = np.array(  # 各行在打包标志物向量中的下标
+            [MARKER_IDX[m] for m in self.markers], dtype=np.intp
+        )
+        cpt_q = np.round(cpt * Q7_SCALE)
+        
+        # 非零概率低于 Q0.7 精度（< 0.5/127）时会被量化为0，相当于隐式硬排除；
+        # 此类条目提升到最小码值 1（≈0.0079）并给出警告
+        underflow = (cpt_q == 0) & (cpt > 0)
+        if underflow.any():
+            warnings.warn(
+                'CPT 中 %d 个非零概率低于 Q0.7 精度（0.5/127），已按 1/127 处理'
+                % int(underflow.sum())
+            )
+            cpt_q[underflow] = 1
+        self.cpt_q = cpt_q.astype(np.int8)  # (标志物, 诊断, 阴/阳)
+        self.marker_rows = np.arange(len(self.markers))
+    
+    def ihc_messages(self, ihc_vec):
+        """
+        各已检测标志物团向 Dx 传递的对数消息，形状 (已检测数, D)
+        """
+        values = ihc_vec[self.cpt_rows]
+        observed = ~np.isnan(values)
+        state = (values[observed] > 0).astype(np.intp)
+        return _LOG_Q7[self.cpt_q[self.marker_rows[observed], :, state]]
+    
+    def absorb_ihc(self, ihc_vec):
+        """
+        IHC证据吸收：已检测标志物团向 Dx 传递的对数消息之和
+        """
+        return self.ihc_messages(ihc_vec).sum(axis=0)
+    
+    def absorb_ihc_batch(self, ihc_matrix):
+        """
+        批量IHC证据吸收：阳性/阴性观测矩阵 (N, M) 与对数CPT (M, D) 相乘
+        """
+        values = ihc_matrix[:, self.cpt_rows]
+        positive = (values > 0).astype(np.float64)
+        negative = (values <= 0).astype(np.float64)  # NaN（未检测）两者皆为0
+        log_cpt = _LOG_Q7[self.cpt_q]
+        return positive @ log_cpt[:, :, 1] + negative @ log_cpt[:, :, 0]
+    
+    def query(self, log_prior, *log_messages):
+        """
+        P(Dx | 证据)：对数先验与各团消息求和后归一化
+        """
+        log_post = log_prior + sum(log_messages)
+        return np.exp(log_post - logsumexp(log_post))
+    
+    def query_batch(self, log_prior, *log_messages):
+        """
+        批量 P(Dx | 证据)：各行 (N, D) 独立做 softmax
+        """
+        log_post = log_prior + sum(log_messages)
+        return np.exp(log_post - logsumexp(log_post, axis=1, keepdims=True))
+
+
+# log2(i/256) 查表，i=0 处置0（p·log2(p) → 0）
+_LOG2_TBL = np.zeros(257)
+_LOG2_TBL[1:] = np.log2(np.arange(1, 257) / 256)
+
+
+@njit(fastmath=True, cache=True)
+def _entropy_quantized(p):
+    """
+    信息熵的查表近似：p 量化到 1/256 后查 log2，免去逐元素超越函数；
+    p < 1/256 时量化误差过大（整体被舍入为0），改为精确计算
+    """
+    s = 0.0
+    for i in range(p.shape[0]):
+        if p[i] >= 1 / 256:
+            s -= p[i] * _LOG2_TBL[int(p[i] * 256 + 0.5)]
+        elif p[i] > 0:
+            s -= p[i] * np.log2(p[i])
+    return s
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _bootstrap(log_prior, log_evidence, top, B, seed):
+        """
+        证据自助重抽样：每个重复有放回地抽取 K 条证据消息重算后验，
+        返回 top 诊断的 B 个后验样本；各重复独立播种，可并行
+        （numba 内的随机状态按线程独立，不影响 NumPy 全局随机状态）
+        """
+        K, D = log_evidence.shape
+        samples = np.empty(B)
+        for b in prange(B):
+            np.random.seed(seed + b)
+            log_post = log_prior.copy()
+            for _ in range(K):
+                log_post += log_evidence[np.random.randint(K)]
+            
+            # softmax 取 top 分量
+            m = log_post.max()
+            z = 0.0
+            for d in range(D):
+                z += np.exp(log_post[d] - m)
+            samples[b] = np.exp(log_post[top] - m) / z
+        return samples
+else:
+    def _bootstrap(log_prior, log_evidence, top, B, seed):
+        """
+        证据自助重抽样（纯Python回退）：每个重复使用独立的 Generator，
+        不重设 NumPy 全局随机状态
+        """
+        K = log_evidence.shape[0]
+        samples = np.empty(B)
+        for b in range(B):
+            rng = np.random.default_rng(seed + b)
+            log_post = log_prior + log_evidence[rng.integers(K, size=K)].sum(axis=0)
+            samples[b] = np.exp(log_post[top] - logsumexp(log_post))
+        return samples
+
+
 class PathologyDiagnosticEngine:
     """
     病理诊断推理引擎
     基于贝叶斯网络 + 决策树 + 规则系统的混合架构
+    
+    以下钩子本类不提供实现，须由子类定义（实例声明了 __slots__，
+    不能在实例上直接赋值挂接）：
+        形态学特征提取  extract_cell_type / grade_atypia /
+                        count_mitosis / detect_necrosis
+        IHC通路        _epithelial_pathway / _undifferentiated_pathway /
+                        _rms_subtype
+        冲突解决        apply_resolution
+        不确定性评估    parameter_sensitivity
+        报告生成        generate_diagnostic_report
+    子类如需新增实例属性，应声明自己的 __slots__
     """
     
+    __slots__ = (
+        'clinical_data', 'morphology', 'ihc_panel', 'molecular',
+        'diagnosis_space', 'confidence', 'posterior_probs', 'final_diagnosis',
+        '_dx_index', '_dx_names', '_jt', '_prior_table', '_log_prior_table',
+        '_log_prior', '_posterior', '_evidence', '_report_cache', '_kb'
+    )
+    
     def __init__(self):
         self.clinical_data = {}      # 临床信息
         self.morphology = {}         # 形态学特征
         self.ihc_panel = {}          # 免疫组化结果
         self.molecular = {}          # 分子检测
-        self.diagnosis_space = []    # 诊断空间
         self.confidence = 0.0        # 置信度
+        self.posterior_probs = {}    # 后验概率（字典视图）
+        self.final_diagnosis = None  # 冲突解决后的诊断
+        self._report_cache = OrderedDict()  # 病例指纹 → 诊断结果，LRU
+        self._kb = _load_knowledge_base()  # 知识库（先验/似然参数）
+        self.set_diagnosis_space(DIAGNOSIS_SPACE)  # 诊断空间
+        
+    def set_diagnosis_space(self, diagnoses):
+        """
+        设定诊断空间Ω，并建立固定的 诊断→下标 映射
+        """
+        self.diagnosis_space = list(diagnoses)
+        self._dx_names = list(self.diagnosis_space)
+        self._dx_index = {d: i for i, d in enumerate(self._dx_names)}
+        lik = self._kb['lik']
+        self._jt = DiagnosisJunctionTree(lik, _build_cpt(lik, self._dx_names))
+        self._prior_table = self._build_prior_table()
+        self._log_prior_table = np.log(self._prior_table)
+        self._report_cache.clear()
+    
+    def update_knowledge_base(self):
+        """
+        cpt.toml（先验/似然参数）修改后调用：重新加载本实例的知识库，
+        重新编译联结树与先验表，并使已缓存的诊断报告失效；
+        其他引擎实例不受影响
+        """
+        self._kb = _load_knowledge_base()
+        self.set_diagnosis_space(self.diagnosis_space)
+    
+    @staticmethod
+    def _case_key(case_data):
+        """
+        病例数据的规范化指纹：各子字典按键排序后序列化再哈希
+        """
+        canonical = tuple(
+            tuple(sorted(case_data[part].items()))
+            for part in ('clinical', 'histology', 'ihc')
+        )
+        return hashlib.blake2b(
+            pickle.dumps(canonical, protocol=5), digest_size=16
+        ).digest()
+    
+    def _as_vector(self, probs, default):
+        """
+        {诊断: 概率} → 按诊断空间排列的概率向量，缺失项取缺省值
+        """
+        if isinstance(probs, np.ndarray):
+            return probs
+        vec = np.full(len(self._dx_names), default, dtype=np.float64)
+        for diagnosis, p in probs.items():
+            i = self._dx_index.get(diagnosis)
+            if i is not None:
+                vec[i] = p
+        return vec
+    
+    def _as_dict(self, vec):
+        """
+        概率向量 → {诊断: 概率}，仅用于接口输出
+        """
+        return dict(zip(self._dx_names, vec.tolist()))
         
     # ========== 链路1：先验概率计算 ==========
+    def _build_prior_table(self):
+        """
+        预计算各临床特征分桶的归一化先验
+        形状 (年龄桶, 部位桶, 尺寸桶, 诊断数)
+        """
+        prior_kb = self._kb['prior']
+        table = np.empty((2, NUM_LOCS, 2, len(self._dx_names)))
+        for age_bucket in range(2):
+            for loc_bucket in range(NUM_LOCS):
+                for size_bucket in range(2):
+                    # 年龄因子
+                    if age_bucket:
+                        prior_probs = dict(prior_kb['age_over_50'])
+                    else:
+                        prior_probs = dict(prior_kb['age_50_or_under'])
+                    
+                    # 部位因子
+                    if loc_bucket:
+                        for d, factor in prior_kb['location_factor'].items():
+                            prior_probs[d] = factor * prior_probs.get(
+                                d, prior_kb['default']
+                            )
+                    
+                    # 尺寸因子
+                    if size_bucket:
+                        for d, factor in prior_kb['size_factor'].items():
+                            prior_probs[d] = factor * prior_probs.get(
+                                d, prior_kb['default']
+                            )
+                    
+                    # 先在已列出诊断内归一化，未列出诊断再取缺省先验；
+                    # 最后整体缩放使各行和为1（不改变诊断间的先验比值）
+                    total = sum(prior_probs.values())
+                    vec = self._as_vector(
+                        {k: v/total for k, v in prior_probs.items()},
+                        prior_kb['default']
+                    )
+                    table[age_bucket, loc_bucket, size_bucket] = vec / vec.sum()
+        table.flags.writeable = False
+        return table
+    
+    @staticmethod
+    def _prior_bucket(clinical_features):
+        """
+        临床特征 → 先验表分桶 (年龄桶, 部位桶, 尺寸桶)
+        """
+        return (
+            int(clinical_features['age'] > 50),
+            LOC2IDX.get(clinical_features['location'], 0),
+            int(clinical_features['size'] > 15)  # cm
+        )
+    
     def calculate_prior(self, clinical_features):
         """
-        基于临床特征计算先验概率
+        基于临床特征计算先验概率（查表）
         """
-        prior_probs = {}
+        bucket = self._prior_bucket(clinical_features)
         
-        # 年龄因子
-        age = clinical_features['age']
-        if age > 50:
-            prior_probs['DDLPS'] = 0.35
-            prior_probs['RMS'] = 0.02  # 成人RMS罕见
-        else:
-            prior_probs['DDLPS'] = 0.10
-            prior_probs['RMS'] = 0.15
-            
-        # 部位因子
-        location = clinical_features['location']
-        if location in ['大腿深部', '腹膜后']:
-            prior_probs['DDLPS'] *= 2.0  # 好发部位加权
-            
-        # 尺寸因子
-        size = clinical_features['size']
-        if size > 15:  # cm
-            prior_probs['DDLPS'] *= 1.5  # 巨大肿物倾向
-            
-        # 归一化
-        total = sum(prior_probs.values())
-        return {k: v/total for k, v in prior_probs.items()}
+        # 同时取出对数先验，供对数域贝叶斯融合直接使用
+        self._log_prior = self._log_prior_table[bucket]
+        return self._prior_table[bucket]
     
     # ========== 链路2：形态学模式识别 ==========
     def morphology_analysis(self, histology):
         """
         形态学特征提取与分类
+        特征打包为单个整数状态（Cell/Atypia/Mitosis/Necrosis 各占3位）；
+        extract_* 可返回枚举或中文描述
         """
-        features = {
-            '细胞类型': self.extract_cell_type(histology),
-            '异型性': self.grade_atypia(histology),
-            '核分裂': self.count_mitosis(histology),
-            '坏死': self.detect_necrosis(histology)
-        }
-        
-        # 形态学模式匹配
-        if features['细胞类型'] == '梭形细胞':
-            if features['异型性'] == '高':
-                candidates = ['DDLPS', 'UPS', 'LMS', 'MPNST']
-            else:
-                candidates = ['WDLPS', '纤维瘤病']
+        state = _pack_morphology(
+            _decode_feature(self.extract_cell_type(histology), Cell, CELL_CODE),
+            _decode_feature(
+                self.grade_atypia(histology), Atypia, ATYPIA_CODE, Atypia.LOW
+            ),
+            _decode_feature(
+                self.count_mitosis(histology), Mitosis, MITOSIS_CODE,
+                Mitosis.UNSPECIFIED
+            ),
+            _decode_feature(
+                self.detect_necrosis(histology), Necrosis, NECROSIS_CODE,
+                Necrosis.UNSPECIFIED
+            )
+        )
         
-        return candidates, features
+        # 形态学模式匹配：一次查表
+        return MORPH_LOOKUP.get(state, ()), state
+    
+    def _morphology_likelihood(self, candidates):
+        """
+        形态学似然：候选诊断获得支持，其余取缺省值
+        """
+        morph_kb = self._kb['morphology']
+        return self._as_vector(
+            {d: morph_kb['candidate'] for d in candidates}, morph_kb['default']
+        )
     
     # ========== 链路3：免疫组化决策树 ==========
-    def ihc_decision_tree(self, ihc_results):
+    def ihc_decision_tree(self, ihc_results, log_likelihood=None):
         """
         分层免疫组化决策
+        ihc_results 可为字典或已打包的标志物向量；
+        log_likelihood 为已批量计算好的对数似然时不再重复吸收证据
         """
-        # 第一层：谱系归属
-        if ihc_results.get('CK') or ihc_results.get('EMA'):
-            return self._epithelial_pathway()
+        # 标志物向量只打包一次，各通路按固定下标读取
+        if isinstance(ihc_results, np.ndarray):
+            vec = ihc_results
+        else:
+            vec = _pack_ihc(ihc_results)
         
-        # 第二层：间叶分化
-        lineage_markers = {
-            'smooth_muscle': ['SMA', 'Desmin', 'Caldesmon'],
-            'skeletal_muscle': ['Myogenin', 'Desmin', 'MyoD1'],
-            'neural': ['S100', 'SOX10'],
-            'vascular': ['CD31', 'ERG', 'CD34'],
-            'adipocytic': ['MDM2', 'CDK4']
-        }
+        # 阳性标志物位图
+        bits = _positive_bits(vec)
         
-        activated_pathways = []
-        for lineage, markers in lineage_markers.items():
-            if any(ihc_results.get(m, 0) > 0 for m in markers):
-                activated_pathways.append(lineage)
+        # 第一层：谱系归属
+        if bits & (M_CK | M_EMA):
+            result = self._epithelial_pathway()
         
-        # 第三层：特异性诊断
-        if 'adipocytic' in activated_pathways:
-            return self._liposarcoma_pathway(ihc_results)
-        elif 'skeletal_muscle' in activated_pathways:
-            return self._rhabdomyosarcoma_pathway(ihc_results)
+        # 第二层：间叶分化 + 第三层：特异性诊断
+        elif bits & LINEAGE_MASK['adipocytic']:
+            result = self._liposarcoma_pathway(vec, bits)
+        elif bits & LINEAGE_MASK['skeletal_muscle']:
+            result = self._rhabdomyosarcoma_pathway(vec, bits)
         else:
-            return self._undifferentiated_pathway(ihc_results)
+            result = self._undifferentiated_pathway(vec)
+        
+        # 似然与通路无关：整组IHC证据在联结树上吸收
+        if result is not None:
+            if log_likelihood is None:
+                log_likelihood = self._jt.absorb_ihc(vec)
+            result['log_likelihood'] = log_likelihood
+            result['bits'] = bits
+        return result
     
-    def _liposarcoma_pathway(self, ihc):
+    def _liposarcoma_pathway(self, vec, bits):
         """
         脂肪肉瘤专用通路
         """
-        mdm2 = ihc.get('MDM2', 0)
-        cdk4 = ihc.get('CDK4', 0)
-        
         # 核心逻辑
-        if mdm2 > 0 and cdk4 > 0:
+        if bits & M_MDM2 and bits & M_CDK4:
             confidence = 0.95
             
             # 检查异源性分化
-            if ihc.get('Myoglobin', 0) > 0:
-                if ihc.get('Myogenin', 0) == 0:
+            if bits & M_MYOGLOBIN:
+                if not bits & M_MYOGENIN:
                     diagnosis = "DDLPS + 异源性肌源性分化"
                 else:
                     diagnosis = "DDLPS vs RMS collision tumor"
@@ -122,21 +627,18 @@ class PathologyDiagnosticEngine:
         else:
             return None
     
-    def _rhabdomyosarcoma_pathway(self, ihc):
+    def _rhabdomyosarcoma_pathway(self, vec, bits):
         """
         横纹肌肉瘤专用通路
         """
-        myogenin = ihc.get('Myogenin', 0)
-        desmin = ihc.get('Desmin', 0)
-        
         # 严格标准
-        if myogenin > 0 and desmin > 0:
+        if bits & M_MYOGENIN and bits & M_DESMIN:
             return {
                 'diagnosis': 'RMS (需分型)',
                 'confidence': 0.90,
-                'subtyping': self._rms_subtype(ihc)
+                'subtyping': self._rms_subtype(vec)
             }
-        elif myogenin == 0 and desmin == 0:
+        elif not bits & (M_MYOGENIN | M_DESMIN):
             # 强排除逻辑
             return {
                 'diagnosis': 'RMS excluded',
@@ -150,73 +652,97 @@ class PathologyDiagnosticEngine:
             }
     
     # ========== 链路4：贝叶斯网络整合 ==========
-    def bayesian_integration(self, prior, likelihood_ihc, likelihood_morphology):
+    def bayesian_integration(self, prior, likelihood_ihc, likelihood_morphology,
+                             log_prior=None):
         """
-        多证据贝叶斯融合
+        多证据贝叶斯融合（对数域，避免小概率连乘下溢）
+        各输入可为 {诊断: 概率} 字典或按诊断空间排列的向量
         """
-        posterior = {}
+        if log_prior is None:
+            prior = self._as_vector(prior, self._kb['prior']['default'])
+            log_prior = np.log(np.clip(prior, 1e-12, 1.0))
+        likelihood_ihc = self._as_vector(likelihood_ihc, 0.01)
+        likelihood_morphology = self._as_vector(
+            likelihood_morphology, self._kb['morphology']['default']
+        )
         
-        for diagnosis in self.diagnosis_space:
-            # 联合似然
-            joint_likelihood = (
-                likelihood_ihc.get(diagnosis, 0.01) * 
-                likelihood_morphology.get(diagnosis, 0.5)
-            )
-            
-            # 后验计算
-            posterior[diagnosis] = (
-                prior.get(diagnosis, 0.01) * joint_likelihood
-            )
+        # 对数先验 + 对数IHC似然 + 对数形态学似然，logsumexp 归一化
+        return self._jt.query(
+            log_prior,
+            np.log(np.clip(likelihood_ihc, 1e-12, 1.0)),
+            np.log(np.clip(likelihood_morphology, 1e-12, 1.0))
+        )
+    
+    def evidence_breakdown(self, clinical_features, ihc_results,
+                           morphology_candidates):
+        """
+        单例证据的逐步分解（供推导文档使用），不改动引擎状态
+        返回各 {诊断: 概率}：先验、各已检测标志物的 P(观测 | 诊断)、
+        IHC联合似然、仅IHC的后验及加入形态学证据后的后验
+        """
+        bucket = self._prior_bucket(clinical_features)
+        log_prior = self._log_prior_table[bucket]
         
-        # 归一化
-        total = sum(posterior.values())
-        if total > 0:
-            posterior = {k: v/total for k, v in posterior.items()}
+        ihc_vec = _pack_ihc(ihc_results)
+        observed = ~np.isnan(ihc_vec[self._jt.cpt_rows])
+        ihc_messages = self._jt.ihc_messages(ihc_vec)
+        log_lik_ihc = ihc_messages.sum(axis=0)
+        log_lik_morph = np.log(self._morphology_likelihood(morphology_candidates))
         
-        return posterior
+        markers = [m for m, seen in zip(self._jt.markers, observed) if seen]
+        return {
+            'prior': self._as_dict(self._prior_table[bucket]),
+            'ihc_factors': {
+                m: self._as_dict(np.exp(message))
+                for m, message in zip(markers, ihc_messages)
+            },
+            'likelihood_ihc': self._as_dict(np.exp(log_lik_ihc)),
+            'posterior_ihc': self._as_dict(self._jt.query(log_prior, log_lik_ihc)),
+            'posterior': self._as_dict(
+                self._jt.query(log_prior, log_lik_ihc, log_lik_morph)
+            )
+        }
     
     # ========== 链路5：规则冲突解决 ==========
+    def detect_conflicts(self, evidence_dict):
+        """
+        证据冲突检测：整张规则表对证据位图一次性求值，返回触发的处理动作
+        """
+        bits = evidence_dict['bits']
+        
+        candidates = MORPH_LOOKUP.get(evidence_dict['morphology'], ())
+        if 'DDLPS' not in candidates:
+            bits |= E_MORPH_NON_LPS
+        
+        bits = np.uint64(bits)
+        req = CONFLICT_RULES['req']
+        forbid = CONFLICT_RULES['forbid']
+        hits = np.flatnonzero(((req & bits) == req) & ((forbid & bits) == 0))
+        return CONFLICT_RULES['action'][hits]
+    
     def resolve_conflicts(self, evidence_dict):
         """
         当证据冲突时的解决策略
         """
-        conflicts = self.detect_conflicts(evidence_dict)
-        
-        for conflict in conflicts:
-            if conflict['type'] == 'MDM2+ but morphology atypical':
-                # 分子标志物优先
-                resolution = {
-                    'priority': 'molecular',
-                    'action': '保持DDLPS诊断，注释形态学变异',
-                    'confidence_penalty': -0.05
-                }
-            
-            elif conflict['type'] == 'Myoglobin+ but Myogenin-':
-                # 逻辑排除优先
-                resolution = {
-                    'priority': 'exclusion_logic',
-                    'interpretation': '异源性分化而非原发RMS',
-                    'confidence_boost': +0.10
-                }
-            
-            self.apply_resolution(resolution)
+        for action in self.detect_conflicts(evidence_dict):
+            self.apply_resolution(CONFLICT_RESOLUTIONS[action])
         
         return self.final_diagnosis
     
     # ========== 链路6：不确定性量化 ==========
-    def uncertainty_quantification(self):
+    def uncertainty_quantification(self, quantized_entropy=False):
         """
         诊断不确定性的数学量化
+        信息熵默认按全精度计算；quantized_entropy=True 时改用查表近似
         """
         # 信息熵
-        entropy = -sum(
-            p * np.log2(p) 
-            for p in self.posterior_probs.values() 
-            if p > 0
-        )
+        if quantized_entropy:
+            entropy = _entropy_quantized(self._posterior)
+        else:
+            entropy = float(entr(self._posterior).sum()) / math.log(2)
         
         # 置信区间
-        top_diagnosis = max(self.posterior_probs, key=self.posterior_probs.get)
+        top_diagnosis = self._dx_names[int(self._posterior.argmax())]
         confidence_interval = self.bootstrap_ci(top_diagnosis)
         
         # 敏感性分析
@@ -229,6 +755,17 @@ class PathologyDiagnosticEngine:
             'recommendation': self.generate_recommendation(entropy)
         }
     
+    def bootstrap_ci(self, top_diagnosis, B=1000, seed=0):
+        """
+        首位诊断后验概率的95%自助置信区间
+        """
+        log_prior, log_evidence = self._evidence
+        samples = _bootstrap(
+            log_prior, log_evidence, self._dx_index[top_diagnosis], B, seed
+        )
+        lo, hi = np.quantile(samples, [0.025, 0.975])
+        return float(lo), float(hi)
+    
     def generate_recommendation(self, entropy):
         """
         基于不确定性的后续建议
@@ -245,6 +782,17 @@ class PathologyDiagnosticEngine:
         """
         完整诊断流程
         """
+        # 相同病例直接返回缓存报告
+        key = self._case_key(case_data)
+        cached = self._report_cache.get(key)
+        if cached is not None:
+            self._report_cache.move_to_end(key)
+            outcome, self._posterior, self._evidence = copy.deepcopy(cached)
+            report, self.final_diagnosis, self.confidence = outcome
+            self._log_prior = self._evidence[0]
+            self.posterior_probs = self._as_dict(self._posterior)
+            return report  # 深拷贝：调用方修改报告不影响缓存
+        
         # 步骤1：先验概率
         prior = self.calculate_prior(case_data['clinical'])
         
@@ -253,20 +801,94 @@ class PathologyDiagnosticEngine:
             self.morphology_analysis(case_data['histology'])
         
         # 步骤3：免疫组化决策
-        ihc_result = self.ihc_decision_tree(case_data['ihc'])
+        ihc_vec = _pack_ihc(case_data['ihc'])
+        ihc_messages = self._jt.ihc_messages(ihc_vec)
+        log_lik_ihc = ihc_messages.sum(axis=0)
+        ihc_result = self.ihc_decision_tree(ihc_vec, log_lik_ihc)
+        
+        # 步骤4：贝叶斯整合（联结树已编译，仅传播本例证据）
+        log_lik_morph = np.log(self._morphology_likelihood(morphology_candidates))
+        posterior = self._jt.query(
+            self._log_prior,
+            log_lik_ihc,
+            log_lik_morph
+        )
         
-        # 步骤4：贝叶斯整合
-        posterior = self.bayesian_integration(
-            prior, 
-            ihc_result['likelihood'],
-            morph_features['likelihood']
+        report = self._report_from_posterior(
+            prior, posterior, ihc_result, _positive_bits(ihc_vec), morph_features,
+            (self._log_prior, np.vstack([ihc_messages, log_lik_morph]))
         )
+        self._report_cache[key] = copy.deepcopy((
+            (report, self.final_diagnosis, self.confidence),
+            posterior, self._evidence
+        ))
+        if len(self._report_cache) > REPORT_CACHE_SIZE:
+            self._report_cache.popitem(last=False)
+        return report
+    
+    def diagnose_batch(self, cases):
+        """
+        队列批量诊断：先验、似然、后验按 (病例数, 诊断数) 矩阵一次性计算，
+        仅最后的报告生成逐例进行
+        """
+        num_dx = len(self._dx_names)
+        
+        # 步骤1：临床特征分桶 → 先验表行号
+        rows = np.array([
+            np.ravel_multi_index(
+                self._prior_bucket(case['clinical']), (2, NUM_LOCS, 2)
+            )
+            for case in cases
+        ], dtype=np.intp)
+        prior = self._prior_table.reshape(-1, num_dx)[rows]
+        log_prior = self._log_prior_table.reshape(-1, num_dx)[rows]
+        
+        # 步骤2：形态学分析
+        morphology = [self.morphology_analysis(case['histology']) for case in cases]
+        log_lik_morph = np.log(np.array([
+            self._morphology_likelihood(candidates) for candidates, _ in morphology
+        ])).reshape(len(cases), num_dx)
+        
+        # 步骤3-4：IHC证据批量吸收 + 批量后验
+        ihc_matrix = np.array(
+            [_pack_ihc(case['ihc']) for case in cases], dtype=np.float32
+        ).reshape(len(cases), NUM_MARKERS)
+        log_lik_ihc = self._jt.absorb_ihc_batch(ihc_matrix)
+        posterior = self._jt.query_batch(log_prior, log_lik_ihc, log_lik_morph)
+        
+        # 步骤5-7：逐例冲突解决、不确定性评估与报告
+        reports = []
+        for i, case in enumerate(cases):
+            ihc_result = self.ihc_decision_tree(ihc_matrix[i], log_lik_ihc[i])
+            log_evidence = np.vstack([
+                self._jt.ihc_messages(ihc_matrix[i]), log_lik_morph[i]
+            ])
+            reports.append(self._report_from_posterior(
+                prior[i], posterior[i], ihc_result, _positive_bits(ihc_matrix[i]),
+                morphology[i][1],
+                (log_prior[i], log_evidence)
+            ))
+        return reports
+    
+    def _report_from_posterior(self, prior, posterior, ihc_result, ihc_bits,
+                               morph_features, evidence):
+        """
+        诊断流程的后半段：冲突解决、不确定性评估、生成报告
+        ihc_bits 为阳性标志物位图，与通路结果无关（通路可能返回 None）；
+        evidence 为 (对数先验, 各条证据的对数消息)，供自助法置信区间重抽样
+        """
+        self._posterior = posterior
+        self._evidence = evidence
+        self.posterior_probs = self._as_dict(posterior)
         
-        # 步骤5：冲突解决
+        # 步骤5：冲突解决（逐例重置，避免沿用上一病例的结论）
+        self.final_diagnosis = None
+        self.confidence = 0.0
         final = self.resolve_conflicts({
             'prior': prior,
             'posterior': posterior,
             'ihc': ihc_result,
+            'bits': ihc_bits,
             'morphology': morph_features
         })
         
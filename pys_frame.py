@@ -1,97 +1,174 @@
-# 定义诊断空间
-Ω = {DDLPS, RMS, UPS, LMS, 其他肉瘤}
-
-# 观察证据集
-E = {
-    临床: (年龄=59, 性别=女, 部位=大腿深部, 大小=20cm),
-    形态: (梭形细胞, 高异型性, 核分裂多, 多核巨细胞),
-    IHC: {
-        MDM2: 1,      # 阳性=1
-        CDK4: 0.3,    # 少量阳性=0.3
-        Myogenin: 0,  # 阴性=0
-        Desmin: 0,
-        Myoglobin: 1,
-        CD99: 1,
-        其他: 全阴性
-    }
+"""
+贝叶斯推理框架推导文档生成器
+推导中的先验、似然与后验全部由诊断引擎（联结树）计算，参数取自 cpt.toml，
+修改概率只需改 cpt.toml：
+    python pys_frame.py > pys_frame.md
+"""
+from PathologyDiagnosticEngine import (
+    MORPH_CANDIDATES, Atypia, Cell, PathologyDiagnosticEngine
+)
+
+# 观察证据集（本例）
+CASE_CLINICAL = {'age': 59, 'sex': '女', 'location': '大腿深部', 'size': 20}
+CASE_MORPHOLOGY = ('梭形细胞', '高异型性', '核分裂多', '多核巨细胞')
+CASE_MORPH_KEY = (Cell.SPINDLE, Atypia.HIGH)
+CASE_IHC = {
+    'MDM2': 1,      # 阳性=1
+    'CDK4': 0.3,    # 少量阳性=0.3
+    'Myogenin': 0,  # 阴性=0
+    'Desmin': 0,
+    'Myoglobin': 1,
+    'CD99': 1
 }
 
-# 先验概率（基于临床特征）
-P(DDLPS | 临床) = 0.35  # 大腿深部巨大肿物，中老年
-P(RMS | 临床) = 0.05    # 成人多形性RMS罕见
-P(UPS | 临床) = 0.30    # 常见高级别肉瘤
-P(LMS | 临床) = 0.20    # 平滑肌肉瘤
-P(其他 | 临床) = 0.10
-
-# 似然函数（证据在各诊断下的概率）
-P(E_IHC | DDLPS) = P(MDM2=1|DDLPS) × P(CDK4>0|DDLPS) × 
-                   P(Myogenin=0|DDLPS) × P(Myoglobin=1|DDLPS异源性)
-                 = 0.97 × 0.92 × 0.95 × 0.08
-                 ≈ 0.068
-
-P(E_IHC | RMS) = P(MDM2=1|RMS) × P(Myogenin=0|RMS)
-               ≈ 0.01 × 0.05  # MDM2在RMS中罕见，Myogenin阴性罕见
-               ≈ 0.0005
-
-P(E_IHC | UPS) = P(MDM2=1|UPS) × ...
-               ≈ 0.02  # UPS中MDM2罕见阳性
-
-# 贝叶斯更新
-P(DDLPS | E) = P(E_IHC | DDLPS) × P(DDLPS | 临床) / P(E_IHC)
-             = (0.068 × 0.35) / Σ[P(E_IHC|dᵢ) × P(dᵢ|临床)]
-             = 0.0238 / (0.0238 + 0.000025 + 0.006 + ...)
-             ≈ 0.0238 / 0.032
-             ≈ 0.74
-
-# 加入形态学证据后
-P(DDLPS | E_完整) ≈ 0.95
-```
-
-### **2.2 决策树数学模型**
-```
-定义决策函数 D: E → Ω
-
-D(E) = argmax_{d∈Ω} [P(d|E) × U(d)]
-
-其中 U(d) 为效用函数（诊断正确的临床价值）
-
-决策规则：
-IF P(DDLPS|E) > θ₁ = 0.90 THEN 诊断=DDLPS
-ELSE IF P(DDLPS|E) > θ₂ = 0.70 THEN 建议分子检测
-ELSE 重新评估
-
-实际计算：
-P(DDLPS|E_本例) ≈ 0.95 > θ₁
-→ 诊断成立，但建议分子确认（穿刺样本限制）
-```
-
-### **2.3 逻辑代数表达**
-```
-定义命题变量：
-M := MDM2阳性
-C := CDK4阳性  
-G := Myogenin阳性
-D := Desmin阳性
-Y := Myoglobin阳性
-R := 诊断为RMS
-L := 诊断为DDLPS
-
-逻辑公式：
-
-1. DDLPS充分条件：
-   (M ∧ C) → L  [置信度 0.95]
-
-2. RMS必要条件：
-   R → (G ∨ D)  [逆否命题]
-   (¬G ∧ ¬D) → ¬R  [强排除]
-
-3. 异源性分化解释：
-   (L ∧ Y) → "DDLPS伴异源性肌源性分化"
-   
-4. 完整诊断逻辑：
-   [(M ∧ C) ∧ (¬G ∧ ¬D) ∧ Y] → "DDLPS + 异源性分化"
-
-真值赋值（本例）：
-M=T, C=T, G=F, D=F, Y=T
-→ L=T (DDLPS成立)
-→ R=F (RMS排除)
\ No newline at end of file
+# 决策门限
+THETA_1 = 0.90
+THETA_2 = 0.70
+
+
+def _sign(value):
+    return '+' if value > 0 else '-'
+
+
+def render():
+    """
+    生成推导文档（Markdown）
+    """
+    engine = PathologyDiagnosticEngine()
+    dx = engine.diagnosis_space
+    breakdown = engine.evidence_breakdown(
+        CASE_CLINICAL, CASE_IHC, MORPH_CANDIDATES[CASE_MORPH_KEY]
+    )
+    prior = breakdown['prior']
+    factors = breakdown['ihc_factors']  # 各已检测标志物的 P(观测 | 诊断)
+    likelihood = breakdown['likelihood_ihc']
+
+    lines = ['```', '# 定义诊断空间', 'Ω = {%s}' % ', '.join(dx), '']
+
+    # 观察证据集
+    clinical = CASE_CLINICAL
+    lines += [
+        '# 观察证据集',
+        'E = {',
+        '    临床: (年龄=%d, 性别=%s, 部位=%s, 大小=%dcm),' % (
+            clinical['age'], clinical['sex'], clinical['location'], clinical['size']
+        ),
+        '    形态: (%s),' % ', '.join(CASE_MORPHOLOGY),
+        '    IHC: {'
+    ]
+    lines += ['        %s: %s,' % (m, v) for m, v in CASE_IHC.items()]
+    lines += ['        其他: 全阴性', '    }', '}', '']
+
+    # 先验概率
+    lines.append('# 先验概率（基于临床特征）')
+    lines += ['P(%s | 临床) = %.3f' % (d, p) for d, p in prior.items()]
+    lines.append('')
+
+    # 似然函数
+    lines.append('# 似然函数（证据在各诊断下的概率）')
+    for d in dx:
+        terms = ' × '.join('P(%s%s|%s)' % (m, _sign(CASE_IHC[m]), d) for m in factors)
+        lines += [
+            'P(E_IHC | %s) = %s' % (d, terms),
+            '    = %s' % ' × '.join('%.2f' % f[d] for f in factors.values()),
+            '    ≈ %.4g' % likelihood[d]
+        ]
+    lines.append('')
+
+    # 贝叶斯更新
+    p_ihc = breakdown['posterior_ihc']['DDLPS']
+    joint_ddlps = likelihood['DDLPS'] * prior['DDLPS']
+    lines += [
+        '# 贝叶斯更新',
+        'P(DDLPS | E) = P(E_IHC | DDLPS) × P(DDLPS | 临床) / P(E_IHC)',
+        '    = (%.4g × %.3f) / Σ[P(E_IHC|dᵢ) × P(dᵢ|临床)]' % (
+            likelihood['DDLPS'], prior['DDLPS']
+        ),
+        '    = %.4g / %.4g' % (joint_ddlps, joint_ddlps / p_ihc),
+        '    ≈ %.2f' % p_ihc,
+        ''
+    ]
+
+    # 加入形态学证据
+    p_full = breakdown['posterior']['DDLPS']
+    lines += ['# 加入形态学证据后', 'P(DDLPS | E_完整) ≈ %.2f' % p_full, '```', '']
+
+    # 决策树数学模型
+    if p_full > THETA_1:
+        actual = 'P(DDLPS|E_本例) ≈ %.2f > θ₁' % p_full
+        decision = '→ 诊断成立，但建议分子确认（穿刺样本限制）'
+    elif p_full > THETA_2:
+        actual = 'P(DDLPS|E_本例) ≈ %.2f > θ₂' % p_full
+        decision = '→ 建议分子检测'
+    else:
+        actual = 'P(DDLPS|E_本例) ≈ %.2f ≤ θ₂' % p_full
+        decision = '→ 重新评估'
+    lines += [
+        '### **2.2 决策树数学模型**',
+        '```',
+        '定义决策函数 D: E → Ω',
+        '',
+        'D(E) = argmax_{d∈Ω} [P(d|E) × U(d)]',
+        '',
+        '其中 U(d) 为效用函数（诊断正确的临床价值）',
+        '',
+        '决策规则：',
+        'IF P(DDLPS|E) > θ₁ = %.2f THEN 诊断=DDLPS' % THETA_1,
+        'ELSE IF P(DDLPS|E) > θ₂ = %.2f THEN 建议分子检测' % THETA_2,
+        'ELSE 重新评估',
+        '',
+        '实际计算：',
+        actual,
+        decision,
+        '```',
+        ''
+    ]
+
+    # 逻辑代数表达
+    truth = {
+        symbol: CASE_IHC.get(marker, 0) > 0
+        for symbol, marker in (
+            ('M', 'MDM2'), ('C', 'CDK4'), ('G', 'Myogenin'),
+            ('D', 'Desmin'), ('Y', 'Myoglobin')
+        )
+    }
+    is_ddlps = truth['M'] and truth['C']
+    is_rms = truth['G'] or truth['D']
+    lines += [
+        '### **2.3 逻辑代数表达**',
+        '```',
+        '定义命题变量：',
+        'M := MDM2阳性',
+        'C := CDK4阳性',
+        'G := Myogenin阳性',
+        'D := Desmin阳性',
+        'Y := Myoglobin阳性',
+        'R := 诊断为RMS',
+        'L := 诊断为DDLPS',
+        '',
+        '逻辑公式：',
+        '',
+        '1. DDLPS充分条件：',
+        '   (M ∧ C) → L',
+        '',
+        '2. RMS必要条件：',
+        '   R → (G ∨ D)  [逆否命题]',
+        '   (¬G ∧ ¬D) → ¬R  [强排除]',
+        '',
+        '3. 异源性分化解释：',
+        '   (L ∧ Y) → "DDLPS伴异源性肌源性分化"',
+        '',
+        '4. 完整诊断逻辑：',
+        '   [(M ∧ C) ∧ (¬G ∧ ¬D) ∧ Y] → "DDLPS + 异源性分化"',
+        '',
+        '真值赋值（本例）：',
+        ', '.join('%s=%s' % (s, 'T' if v else 'F') for s, v in truth.items()),
+        '→ L=%s (DDLPS%s)' % ('T' if is_ddlps else 'F', '成立' if is_ddlps else '不成立'),
+        '→ R=%s (RMS%s)' % ('T' if is_rms else 'F', '未排除' if is_rms else '排除'),
+        '```'
+    ]
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(render())